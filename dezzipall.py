@@ -1,10 +1,32 @@
 import os
 import subprocess
 import logging
+import logging.handlers
 import argparse
 from pathlib import Path
 import sys
 import platform # Per determinare il percorso predefinito di 7z
+import json
+import tempfile
+import shutil
+import functools
+import itertools
+import tarfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    import py7zr # Opzionale: se installato, i .7z vengono estratti senza avviare 7z
+except ImportError:
+    py7zr = None
+
+# Estensioni riconosciute come archivi (minuscole). Aggiungi altre estensioni se necessario (es. .rar)
+_ARCHIVE_SUFFIXES = frozenset({'.zip', '.7z', '.tar', '.gz', '.tgz', '.bz2', '.xz'})
+# Estensioni doppie: la cartella di destinazione perde anche il '.tar'
+_DOUBLE_SUFFIXES = ('.tar.gz', '.tar.bz2', '.tar.xz')
+# Archivi tar (anche compressi) estratti direttamente in Python con tarfile, senza avviare 7z
+_TAR_SUFFIXES = ('.tar', '.tgz') + _DOUBLE_SUFFIXES
+# Numero minimo di archivi per blocco quando un gruppo viene diviso tra i thread
+_MIN_BATCH_SIZE = 8
 
 # --- Configurazione del Logging ---
 def setup_logging(log_file='extraction.log'):
@@ -15,10 +37,12 @@ def setup_logging(log_file='extraction.log'):
     logger = logging.getLogger()
     logger.setLevel(logging.INFO) # Livello base, cattura INFO, WARNING, ERROR, CRITICAL
 
-    # Handler per scrivere su file
+    # Handler per scrivere su file, con buffer in memoria: scrive a blocchi di record,
+    # subito invece per warning ed errori (e comunque alla chiusura del programma)
     file_handler = logging.FileHandler(log_file, mode='w', encoding='utf-8')
     file_handler.setFormatter(log_formatter)
-    logger.addHandler(file_handler)
+    buffered_handler = logging.handlers.MemoryHandler(capacity=1024, flushLevel=logging.WARNING, target=file_handler)
+    logger.addHandler(buffered_handler)
 
     # Handler per scrivere sulla console
     stream_handler = logging.StreamHandler(sys.stdout)
@@ -27,160 +51,460 @@ def setup_logging(log_file='extraction.log'):
 
     logging.info("Logging configurato. Log salvati in: %s", log_file)
 
+# --- Percorso Predefinito di 7z ---
+@functools.lru_cache(maxsize=None)
+def _default_7z_path():
+    """Determina (una sola volta) il percorso predefinito di 7z in base al SO."""
+    if platform.system() == "Windows":
+        # Prova percorsi comuni su Windows
+        program_files = os.environ.get("ProgramFiles", "C:\\Program Files")
+        program_files_x86 = os.environ.get("ProgramFiles(x86)", "C:\\Program Files (x86)")
+        for base_dir in (program_files, program_files_x86):
+            candidate = Path(base_dir, "7-Zip", "7z.exe")
+            if candidate.is_file():
+                return str(candidate)
+        return shutil.which("7z.exe") or "7z.exe" # Prova a vedere se è nel PATH
+    # Su Linux/Mac (e altri), 7z è spesso nel PATH: restituisce il percorso risolto
+    return shutil.which("7z") or "7z"
+
+# --- Cache degli Archivi Già Estratti ---
+CACHE_FILE_NAME = '.dezzipall_cache.json'
+
+def _load_cache(cache_path):
+    """
+    Carica la cache delle esecuzioni precedenti: {percorso_archivio: (dimensione, mtime_ns)}.
+    Restituisce una cache vuota se il file non esiste o non è leggibile.
+    """
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return {sys.intern(path): tuple(key) for path, key in data.items()}
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError, TypeError, AttributeError) as e:
+        logging.warning("Cache %s non leggibile, verrà ricreata. Errore: %s", cache_path, e)
+        return {}
+
+def _save_cache(cache_path, cache):
+    """Salva la cache su disco in modo atomico (file temporaneo + rename)."""
+    tmp_path = f"{cache_path}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, cache_path)
+        logging.debug("Cache salvata in: %s (%d archivi)", cache_path, len(cache))
+    except OSError as e:
+        logging.warning("Impossibile salvare la cache %s. Errore: %s", cache_path, e)
+
+# --- Ricerca degli Archivi ---
+def _find_archives(root):
+    """
+    Visita root una sola volta con os.scandir (stack esplicito, niente ricorsione)
+    e restituisce i DirEntry dei file con estensione da archivio.
+    I DirEntry riusano le informazioni di readdir, evitando stat aggiuntive.
+    """
+    stack = [str(root)]
+    while stack:
+        current_dir = stack.pop()
+        try:
+            with os.scandir(current_dir) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    # Un solo lookup per file; le estensioni doppie terminano comunque con una semplice
+                    elif os.path.splitext(entry.name.lower())[1] in _ARCHIVE_SUFFIXES and entry.is_file():
+                        yield entry
+        except OSError as e:
+            logging.warning("Impossibile leggere la directory %s: %s", current_dir, e)
+
+# --- Liste di File per 7z ---
+def _write_list_file(archive_paths):
+    """Scrive un file temporaneo (UTF-8) con un percorso di archivio per riga, da passare a 7z con '-ai@file'."""
+    fd, list_file = tempfile.mkstemp(prefix='dezzipall_', suffix='.txt')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write("\n".join(archive_paths) + "\n")
+    return list_file
+
+def _remove_list_file(list_file):
+    """Elimina il file temporaneo della lista, ignorando eventuali errori."""
+    try:
+        os.remove(list_file)
+    except OSError:
+        pass
+
+# --- Estrazione di un Singolo Archivio ---
+def _extracted_in_process(archive_path):
+    """Vero se l'archivio viene estratto in Python (tarfile, o py7zr se installato) senza 7z."""
+    low = archive_path.lower()
+    return low.endswith(_TAR_SUFFIXES) or (py7zr is not None and low.endswith('.7z'))
+
+def _destination_dir(archive_path):
+    """
+    Cartella di destinazione: accanto all'archivio, con il nome base senza estensione.
+    Lavora solo su stringhe (niente oggetti Path nel ciclo principale).
+    """
+    archive_dir, archive_name = os.path.split(archive_path)
+    # Gestisce estensioni doppie come .tar.gz
+    stem = os.path.splitext(archive_name)[0]
+    if archive_name.lower().endswith(_DOUBLE_SUFFIXES):
+         base_name = os.path.splitext(stem)[0] # Rimuove anche .tar
+    else:
+         base_name = stem
+    return os.path.join(archive_dir, base_name)
+
+def _extract_one(archive_path, path_to_7z, extra_switches=()):
+    """
+    Estrae un singolo archivio con 7z nella cartella omonima accanto all'archivio.
+    Pensata per essere eseguita in un thread del pool: non modifica lo stato condiviso,
+    restituisce solo una tupla (stato, percorso_archivio).
+    Stati possibili: 'ok', 'warning', 'error'.
+    extra_switches: opzioni aggiuntive per 7z (es. '-mmt').
+    """
+    logging.debug("Trovato archivio da processare: %s", archive_path)
+
+    archive_name = os.path.basename(archive_path)
+    extract_dir = _destination_dir(archive_path)
+
+    logging.debug("Tentativo di estrazione in: %s", extract_dir)
+
+    # Crea la directory di destinazione se non esiste. Non fallisce se esiste.
+    # La cartella padre (quella dell'archivio) esiste sempre: basta os.mkdir, senza la stat di makedirs
+    try:
+        try:
+            os.mkdir(extract_dir)
+        except FileExistsError:
+            # Solo qui serve una stat in più: il percorso esistente potrebbe essere un file
+            if not os.path.isdir(extract_dir):
+                raise
+        logging.debug("Directory di estrazione assicurata: %s", extract_dir)
+    except OSError as e:
+        logging.error("Errore nella creazione della directory di estrazione %s per l'archivio %s. Errore: %s", 
+                      extract_dir, archive_path, e)
+        return 'error', archive_path
+
+    # Tar (e .7z con py7zr) vengono estratti nel processo stesso; in caso di problemi si riprova con 7z
+    if archive_name.lower().endswith(_TAR_SUFFIXES):
+        try:
+            with tarfile.open(archive_path) as tar:
+                if hasattr(tarfile, 'data_filter'):
+                    tar.extractall(extract_dir, filter='data') # Blocca percorsi assoluti e '..'
+                else:
+                    tar.extractall(extract_dir)
+            logging.info("Estrazione di %s completata con successo.", archive_name)
+            return 'ok', archive_path
+        except Exception as e:
+            logging.warning("Estrazione di %s con tarfile non riuscita, si riprova con 7z. Errore: %s", archive_name, e)
+    elif py7zr is not None and archive_name.lower().endswith('.7z'):
+        try:
+            with py7zr.SevenZipFile(archive_path, mode='r') as archive:
+                archive.extractall(path=extract_dir)
+            logging.info("Estrazione di %s completata con successo.", archive_name)
+            return 'ok', archive_path
+        except Exception as e:
+            # Es. metodi di compressione non supportati da py7zr (BCJ2, PPMd su alcune versioni...)
+            logging.warning("Estrazione di %s con py7zr non riuscita, si riprova con 7z. Errore: %s", archive_name, e)
+
+    # Costruisce ed esegue il comando 7z
+    # 'x' = estrai con percorsi completi
+    # '-o' = directory di output (senza spazi)
+    # '-y' = sì a tutte le domande (sovrascrittura)
+    # '-spd' = nomi presi alla lettera, senza interpretare '*' e '?' come caratteri jolly
+    # '-bso0 -bsp0' = niente output normale né avanzamento; '-bse2' = errori su stderr
+    command = [path_to_7z, 'x', archive_path, f'-o{extract_dir}', '-y', '-spd', '-bso0', '-bsp0', '-bse2', *extra_switches]
+    
+    try:
+        logging.debug("Esecuzione comando: %s", " ".join(command))
+        # Lo stdout (già disattivato con -bso0) non serve: viene scartato.
+        # Si conserva solo lo stderr, dove 7z scrive errori e warning.
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=False,
+                                encoding='utf-8', errors='replace')
+    except Exception as e:
+        logging.exception("Errore imprevisto durante l'esecuzione di 7z per %s: %s", archive_path, e)
+        return 'error', archive_path
+
+    # Controlla il risultato dell'esecuzione
+    if result.returncode == 0:
+        logging.info("Estrazione di %s completata con successo.", archive_name)
+        return 'ok', archive_path
+    if result.returncode == 1:
+        # Codice 1: Warning (spesso non fatale, es. file bloccati non sovrascritti)
+        logging.warning("Estrazione di %s completata con Warning (Codice %d). Output:\nSTDERR:\n%s",
+                        archive_name, result.returncode, result.stderr.strip())
+        return 'warning', archive_path
+    # Codice 2 (Errore Fatale) o altri errori
+    logging.error("Errore durante l'estrazione di %s (Codice %d). Comando: %s\nSTDERR:\n%s",
+                  archive_name, result.returncode, " ".join(command), result.stderr.strip())
+    return 'error', archive_path
+
+# --- Estrazione Multipla con una Sola Invocazione di 7z ---
+def _extract_batch(archive_paths, archive_dir, path_to_7z, extra_switches=()):
+    """
+    Estrae più archivi della stessa cartella con un unico processo 7z (lista '-ai@file'),
+    risparmiando l'avvio di un processo per archivio.
+    '-o<cartella>/*' fa creare a 7z una sottocartella col nome dell'archivio senza estensione,
+    come in _extract_one. Restituisce una lista di tuple (stato, percorso_archivio).
+    Se 7z termina con errori, solo gli archivi il cui blocco di output riporta
+    "Everything is Ok" sono considerati riusciti; tutti gli altri vengono ri-estratti
+    singolarmente con _extract_one, per avere codice di uscita e log precisi.
+    """
+    for archive_path in archive_paths:
+        logging.debug("Trovato archivio da processare: %s", archive_path)
+    logging.info("Estrazione di %d archivi in %s con un'unica invocazione di 7z", len(archive_paths), archive_dir)
+
+    list_file = None
+    try:
+        list_file = _write_list_file(archive_paths)
+
+        # '-an' = nessun nome di archivio sulla riga di comando; '-ai@<lista>' = archivi letti dalla lista
+        # (un '@lista' al posto del nome verrebbe cercato come archivio con quel nome letterale)
+        # '-scsUTF-8' = codifica della lista di file; '-spd' = percorsi della lista presi alla lettera
+        # '-bsp0' = niente avanzamento (lo stdout serve invece per attribuire gli esiti)
+        command = [path_to_7z, 'x', '-an', f'-ai@{list_file}', f'-o{os.path.join(archive_dir, "*")}', '-y',
+                   '-scsUTF-8', '-spd', '-bsp0', *extra_switches]
+        logging.debug("Esecuzione comando: %s", " ".join(command))
+        result = subprocess.run(command, capture_output=True, text=True, check=False, encoding='utf-8', errors='replace')
+    except Exception as e:
+        logging.exception("Errore imprevisto durante l'estrazione multipla in %s, si procede archivio per archivio: %s", archive_dir, e)
+        return [_extract_one(p, path_to_7z, extra_switches) for p in archive_paths]
+    finally:
+        if list_file is not None:
+            _remove_list_file(list_file)
+
+    if result.returncode == 0:
+        for archive_path in archive_paths:
+            logging.info("Estrazione di %s completata con successo.", os.path.basename(archive_path))
+        return [('ok', p) for p in archive_paths]
+
+    # Attribuisce l'esito ai singoli archivi: l'output di 7z ha un blocco per archivio
+    # che inizia con "Extracting archive: <percorso>". Conta solo il segnale positivo
+    # "Everything is Ok": gli errori dei singoli file (es. "ERROR: CRC Failed : <file>")
+    # finiscono su stderr e citano il file interno, non l'archivio.
+    blocks = {}
+    current_block = None
+    for line in result.stdout.splitlines():
+        if line.startswith("Extracting archive: "):
+            current_block = blocks.setdefault(line[len("Extracting archive: "):].strip(), [])
+        elif current_block is not None:
+            current_block.append(line)
+
+    results = []
+    for archive_path in archive_paths:
+        block = blocks.get(archive_path)
+        if block is not None and any(line.strip() == "Everything is Ok" for line in block):
+            logging.info("Estrazione di %s completata con successo.", os.path.basename(archive_path))
+            results.append(('ok', archive_path))
+        else:
+            results.append(_extract_one(archive_path, path_to_7z, extra_switches))
+    return results
+
+def _extract_group(archive_paths, path_to_7z, extra_switches=(), use_batch=True):
+    """
+    Estrae un gruppo di archivi della stessa cartella: in blocco (use_batch) se più di uno,
+    altrimenti uno dopo l'altro, nell'ordine dato.
+    """
+    if use_batch and len(archive_paths) > 1:
+        return _extract_batch(archive_paths, os.path.dirname(archive_paths[0]), path_to_7z, extra_switches)
+    return [_extract_one(archive_path, path_to_7z, extra_switches) for archive_path in archive_paths]
+
+def _outermost_dirs(dirs):
+    """Rimuove le cartelle contenute in altre cartelle dell'elenco, per non visitarle due volte."""
+    outermost = []
+    # Ordinando per componenti del percorso, ogni sottocartella segue subito la cartella che la contiene
+    for directory in sorted(dirs, key=lambda d: d.split(os.sep)):
+        if not outermost or not directory.startswith(outermost[-1] + os.sep):
+            outermost.append(directory)
+    return outermost
+
+def _enclosing_destination(path, destinations, root):
+    """Restituisce la cartella di destinazione (tra destinations) che contiene path, o None."""
+    directory = os.path.dirname(path)
+    # Risale fino alla cartella di lavoro: le destinazioni stanno tutte al suo interno
+    while len(directory) > len(root):
+        if directory in destinations:
+            return directory
+        directory = os.path.dirname(directory)
+    return None
+
+def _run_jobs(jobs, path_to_7z, extra_switches, max_workers):
+    """
+    Esegue i lavori, tuple (gruppo di archivi, use_batch), e restituisce man mano i risultati di ciascuno.
+    Un lavoro singolo viene eseguito direttamente nel thread principale, senza creare il pool.
+    """
+    if len(jobs) <= 1:
+        for archive_paths, use_batch in jobs:
+            yield _extract_group(archive_paths, path_to_7z, extra_switches, use_batch)
+        return
+    # I thread restano bloccati in attesa del processo 7z (GIL rilasciato), quindi scalano bene
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as executor:
+        futures = [executor.submit(_extract_group, archive_paths, path_to_7z, extra_switches, use_batch)
+                   for archive_paths, use_batch in jobs]
+        for future in as_completed(futures):
+            yield future.result()
+
 # --- Funzione Principale di Estrazione ---
-def recursive_extract(work_dir, path_to_7z, max_iterations=5):
+def recursive_extract(work_dir, path_to_7z, max_iterations=5, use_cache=True, max_workers=None, use_mmt=True):
     """
     Estrae ricorsivamente archivi trovati in work_dir usando 7z.
     Sovrascrive il contenuto se la cartella di destinazione esiste.
     Non elimina gli archivi originali.
+    Gli archivi di ogni iterazione vengono estratti in parallelo (un processo 7z per thread),
+    con al massimo max_workers estrazioni contemporanee (default: numero di CPU).
+    Con use_mmt, anche 7z decomprime in multithreading (-mmt) dove il formato lo consente.
+    Con use_cache, salta gli archivi estratti con successo in esecuzioni precedenti
+    e non più modificati (stessa dimensione e mtime).
     """
     work_path = Path(work_dir).resolve() # Ottiene il percorso assoluto e risolto
-    path_to_7z = Path(path_to_7z).resolve()
+    # Risolve 7z una sola volta (anche tramite PATH): ogni comando riceve il percorso assoluto
+    resolved_7z = shutil.which(str(path_to_7z)) or str(path_to_7z)
     
     if not work_path.is_dir():
         logging.error("La directory di lavoro specificata non esiste: %s", work_path)
         return
-    if not path_to_7z.is_file():
-        logging.error("L'eseguibile 7z non è stato trovato in: %s", path_to_7z)
+    if not (os.path.isfile(resolved_7z) and os.access(resolved_7z, os.X_OK)):
+        logging.error("L'eseguibile 7z non è stato trovato (o non è eseguibile) in: %s", path_to_7z)
+        return
+    path_to_7z = os.path.abspath(resolved_7z)
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    elif max_workers < 1:
+        logging.error("Il numero di estrazioni in parallelo deve essere almeno 1: %d", max_workers)
         return
 
     logging.info("Inizio estrazione ricorsiva in: %s", work_path)
     logging.info("Utilizzo 7-Zip da: %s", path_to_7z)
     logging.info("Numero massimo di iterazioni: %d", max_iterations)
+    logging.info("Numero massimo di estrazioni in parallelo: %d", max_workers)
+
+    # Decompressione multithread interna a 7z (archivi 7z/xz/bzip2...), disattivabile per VM a singolo core
+    # I thread di ogni 7z sono una quota delle CPU, dato che fino a max_workers processi girano insieme
+    mmt_threads = max(1, (os.cpu_count() or 1) // max_workers)
+    extra_switches = (f'-mmt{mmt_threads}',) if use_mmt else ()
     logging.warning("Gli archivi originali NON verranno eliminati.")
     logging.warning("Il contenuto delle cartelle esistenti verrà sovrascritto durante l'estrazione.")
 
-    processed_archives = set() # Tiene traccia degli archivi già processati in questa esecuzione
-    archive_extensions = ['.zip', '.7z', '.tar', '.gz', '.tgz'] # Aggiungi altre estensioni se necessario (es. .rar, .bz2)
+    processed_archives = set() # Tiene traccia degli archivi già processati in questa esecuzione (modificato solo dal thread principale)
     total_processed_successfully = 0
     total_errors = 0
+    skipped_cached = set() # Archivi saltati perché invariati (contati una volta sola)
+
+    cache_path = work_path / CACHE_FILE_NAME
+    cache = _load_cache(cache_path) if use_cache else {}
+    archive_keys = {} # percorso -> (dimensione, mtime_ns), calcolato con una sola stat per archivio
+    scan_roots = [str(work_path)] # La prima iterazione visita tutto l'albero
 
     for iteration in range(max_iterations):
         logging.info("--- Inizio Iterazione %d di %d ---", iteration + 1, max_iterations)
-        archives_found_this_iteration = []
-        
-        # Trova tutti i file con le estensioni specificate ricorsivamente
-        for ext in archive_extensions:
-            archives_found_this_iteration.extend(list(work_path.rglob(f'*{ext}')))
-            # Gestione specifica per .tar.gz, .tar.bz2 etc. (rglob non li prende con *.gz se sono *.tar.gz)
-            if ext in ['.gz', '.bz2', '.xz']: 
-                 archives_found_this_iteration.extend(list(work_path.rglob(f'*.tar{ext}')))
-
-        # Rimuovi duplicati nel caso di find con .tar.gz e .gz
-        unique_archives_found = list(set(archives_found_this_iteration))
-
-        if not unique_archives_found:
-            logging.info("Nessun file archivio trovato in questa iterazione.")
-            break # Interrompe il ciclo se non ci sono archivi
-
-        newly_processed_in_iteration = 0
-        for archive_path in unique_archives_found:
-            archive_full_path_str = str(archive_path)
+        # Un'unica visita per iterazione, limitata alle cartelle in cui possono esserci nuovi archivi.
+        # Le radici non si sovrappongono (vedi _outermost_dirs), quindi nessun archivio compare due volte:
+        # i risultati vengono consumati man mano, senza liste intermedie né deduplicazione.
+        archives_found = itertools.chain.from_iterable(map(_find_archives, scan_roots))
 
-            # Salta se già processato
-            if archive_full_path_str in processed_archives:
+        pending_by_destination = {} # cartella di destinazione -> archivi da estrarre
+        found_this_iteration = 0
+        for entry in archives_found:
+            found_this_iteration += 1
+            # Percorso internato: hash calcolato una volta sola e confronti per identità
+            # nei set/dict (processed_archives, cache, gruppi), anche tra un'iterazione e l'altra
+            archive_path = sys.intern(entry.path)
+            # Salta gli archivi già processati in questa esecuzione o invariati dall'ultima
+            if archive_path in processed_archives:
                 continue
+            if use_cache:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    pass
+                else:
+                    archive_keys[archive_path] = (st.st_size, st.st_mtime_ns)
+                    # Non va in processed_archives: se un'estrazione successiva lo riscrive (archivio annidato
+                    # aggiornato), l'iterazione seguente lo confronta di nuovo con la cache.
+                    # Se la cartella estratta è stata cancellata, lo si ri-estrae.
+                    if (cache.get(archive_path) == archive_keys[archive_path]
+                            and os.path.isdir(_destination_dir(archive_path))):
+                        logging.debug("Archivio invariato dall'ultima esecuzione, saltato: %s", archive_path)
+                        skipped_cached.add(archive_path)
+                        continue
+            pending_by_destination.setdefault(_destination_dir(archive_path), []).append(archive_path)
 
-            logging.info("Trovato archivio da processare: %s", archive_full_path_str)
+        if not found_this_iteration:
+            logging.info("Nessun file archivio trovato in questa iterazione.")
+            break # Interrompe il ciclo se non ci sono archivi
 
-            archive_name = archive_path.name
-            archive_dir = archive_path.parent
+        # Un archivio dentro la cartella di destinazione di un altro archivio in attesa (es. a/b.tar
+        # rimasto da un'esecuzione precedente, con a.tar da estrarre) viene rinviato: estrarli insieme
+        # leggerebbe b.tar mentre l'estrazione di a.tar lo sta riscrivendo. Alla prossima iterazione
+        # si rivisita la cartella che lo contiene, anche se l'archivio esterno non è andato a buon fine.
+        deferred_roots = set()
+        pending_destinations = frozenset(pending_by_destination)
+        for destination in pending_destinations:
+            enclosing = _enclosing_destination(destination, pending_destinations, str(work_path))
+            if enclosing is not None:
+                logging.debug("Estrazione rinviata (dentro %s, ancora da estrarre): %s",
+                              enclosing, ", ".join(pending_by_destination[destination]))
+                del pending_by_destination[destination]
+                deferred_roots.add(enclosing)
 
-            # Determina il nome della cartella di destinazione (nome base senza estensione)
-            # Gestisce estensioni doppie come .tar.gz
-            stem = archive_path.stem 
-            if archive_path.suffix.lower() in ['.gz', '.bz2', '.xz'] and stem.lower().endswith('.tar'):
-                 base_name = Path(stem).stem # Rimuove anche .tar
+        # Archivi con la stessa cartella di destinazione (es. a.zip e a.7z) restano in un unico lavoro,
+        # estratti uno dopo l'altro: in parallelo si sovrascriverebbero a vicenda.
+        # Gli altri vengono raggruppati per cartella ed estratti con un solo 7z. Fanno eccezione
+        # gli archivi estratti in Python (tar e, con py7zr, .7z); per le estensioni doppie come
+        # .tar.gz, inoltre, il '*' di 7z non darebbe la stessa cartella di destinazione.
+        jobs = [] # tuple (archivi, use_batch)
+        archive_groups = {}
+        for destination_archives in pending_by_destination.values():
+            if len(destination_archives) > 1:
+                jobs.append((sorted(destination_archives), False))
+            elif _extracted_in_process(destination_archives[0]):
+                jobs.append((destination_archives, False))
             else:
-                 base_name = stem
-                 
-            extract_dir = archive_dir / base_name
-
-            logging.info("Tentativo di estrazione in: %s", extract_dir)
-
-            # Crea la directory di destinazione se non esiste. Non fallisce se esiste.
-            try:
-                os.makedirs(extract_dir, exist_ok=True)
-                logging.debug("Directory di estrazione assicurata: %s", extract_dir)
-            except OSError as e:
-                logging.error("Errore nella creazione della directory di estrazione %s per l'archivio %s. Errore: %s", 
-                              extract_dir, archive_full_path_str, e)
-                total_errors += 1
-                processed_archives.add(archive_full_path_str) # Segna come 'processato' per non riprovare all'infinito
-                continue # Passa al prossimo archivio
-
-            # Costruisce ed esegue il comando 7z
-            # 'x' = estrai con percorsi completi
-            # '-o' = directory di output (senza spazi)
-            # '-y' = sì a tutte le domande (sovrascrittura)
-            command = [str(path_to_7z), 'x', archive_full_path_str, f'-o{extract_dir}', '-y']
-            
-            try:
-                logging.debug("Esecuzione comando: %s", " ".join(command))
-                result = subprocess.run(command, capture_output=True, text=True, check=False, encoding='utf-8', errors='replace')
-
-                # Controlla il risultato dell'esecuzione
-                if result.returncode == 0:
-                    logging.info("Estrazione di %s completata con successo.", archive_name)
-                    total_processed_successfully += 1
+                archive_groups.setdefault(os.path.dirname(destination_archives[0]), []).append(destination_archives[0])
+
+        # Divide i gruppi numerosi in blocchi, per non perdere il parallelismo tra i thread.
+        # Compromesso: ogni blocco ha almeno _MIN_BATCH_SIZE archivi, così una cartella con pochi
+        # archivi resta un'unica invocazione di 7z (risparmio di avvii) invece di un processo
+        # per archivio; il parallelismo tra i blocchi si ha solo nelle cartelle più numerose.
+        for group in archive_groups.values():
+            chunk_size = max(_MIN_BATCH_SIZE, -(-len(group) // max_workers)) # Arrotondamento per eccesso
+            jobs.extend((group[i:i + chunk_size], True) for i in range(0, len(group), chunk_size))
+
+        newly_processed_in_iteration = 0
+        new_roots = set() # Cartelle create in questa iterazione: solo lì possono comparire archivi annidati
+        for job_results in _run_jobs(jobs, path_to_7z, extra_switches, max_workers):
+            for status, archive_full_path_str in job_results:
+                if status in ('ok', 'warning'):
+                    total_processed_successfully += 1 # Warning considerato successo parziale/completo
                     newly_processed_in_iteration += 1
                     processed_archives.add(archive_full_path_str)
-                elif result.returncode == 1:
-                    # Codice 1: Warning (spesso non fatale, es. file bloccati non sovrascritti)
-                    logging.warning("Estrazione di %s completata con Warning (Codice %d). Output:\nSTDOUT:\n%s\nSTDERR:\n%s",
-                                    archive_name, result.returncode, result.stdout.strip(), result.stderr.strip())
-                    total_processed_successfully += 1 # Consideralo successo parziale/completo
-                    newly_processed_in_iteration += 1
-                    processed_archives.add(archive_full_path_str) 
+                    new_roots.add(_destination_dir(archive_full_path_str))
+                    if status == 'ok' and archive_full_path_str in archive_keys:
+                        cache[archive_full_path_str] = archive_keys[archive_full_path_str]
                 else:
-                    # Codice 2 (Errore Fatale) o altri errori
-                    logging.error("Errore durante l'estrazione di %s (Codice %d). Comando: %s\nSTDOUT:\n%s\nSTDERR:\n%s",
-                                  archive_name, result.returncode, " ".join(command), result.stdout.strip(), result.stderr.strip())
+                    # Nessun nuovo tentativo: le iterazioni successive visitano solo le cartelle appena estratte
                     total_errors += 1
-                    # Non aggiungere a processed_archives se l'errore è fatale (codice 2), 
-                    # potrebbe essere ritentato (anche se improbabile che funzioni senza intervento). 
-                    # Aggiungilo per altri errori per evitare loop infiniti.
-                    if result.returncode != 2:
-                         processed_archives.add(archive_full_path_str)
-
-            except FileNotFoundError:
-                logging.error("Errore: Impossibile trovare l'eseguibile 7z in %s. Assicurati che il percorso sia corretto.", path_to_7z)
-                return # Interrompe lo script se 7z non è trovatos
-            except Exception as e:
-                logging.exception("Errore imprevisto durante l'esecuzione di 7z per %s: %s", archive_full_path_str, e)
-                total_errors += 1
-                processed_archives.add(archive_full_path_str) # Segna come processato per evitare loop
-
-        if newly_processed_in_iteration == 0 and iteration > 0:
-             logging.info("Nessun *nuovo* archivio processato in questa iterazione. Probabile fine del lavoro utile.")
-             # Potremmo uscire qui, ma continuiamo fino a max_iterations per sicurezza / semplicità
-             # break 
+                    processed_archives.add(archive_full_path_str)
+
+        # Nuovi archivi annidati possono comparire solo dentro cartelle estratte in questa iterazione:
+        # se non è stato estratto nulla, un'altra iterazione ritroverebbe solo archivi già considerati.
+        # Gli archivi rinviati vanno comunque ritentati.
+        if newly_processed_in_iteration == 0 and not deferred_roots:
+             logging.info("Nessun *nuovo* archivio processato in questa iterazione. Fine del lavoro utile.")
+             break
+
+        scan_roots = _outermost_dirs(new_roots | deferred_roots)
+
+    if use_cache:
+        _save_cache(cache_path, cache)
 
     logging.info("--- Processo di Estrazione Terminato ---")
     logging.info("Iterazioni completate: %d", iteration + 1)
     logging.info("Archivi processati con successo (o warning): %d", total_processed_successfully)
     logging.info("Errori riscontrati durante l'estrazione: %d", total_errors)
-    logging.info("Numero totale di percorsi di archivio unici trovati e considerati: %d", len(processed_archives) + total_errors) # Stima approssimativa
+    logging.info("Archivi saltati perché invariati dall'ultima esecuzione: %d", len(skipped_cached - processed_archives))
+    logging.info("Numero totale di percorsi di archivio unici trovati e considerati: %d", len(processed_archives | skipped_cached))
 
 # --- Blocco Principale di Esecuzione ---
 if __name__ == "__main__":
-    # Determina percorso predefinito per 7z basato sul SO
-    default_7z_path = ""
-    if platform.system() == "Windows":
-        # Prova percorsi comuni su Windows
-        program_files = os.environ.get("ProgramFiles", "C:\\Program Files")
-        program_files_x86 = os.environ.get("ProgramFiles(x86)", "C:\\Program Files (x86)")
-        if Path(program_files, "7-Zip", "7z.exe").is_file():
-            default_7z_path = str(Path(program_files, "7-Zip", "7z.exe"))
-        elif Path(program_files_x86, "7-Zip", "7z.exe").is_file():
-             default_7z_path = str(Path(program_files_x86, "7-Zip", "7z.exe"))
-        else:
-             default_7z_path = "7z.exe" # Prova a vedere se è nel PATH
-    elif platform.system() == "Linux" or platform.system() == "Darwin":
-        # Su Linux/Mac, 7z è spesso nel PATH
-        default_7z_path = "7z" 
-    else:
-        default_7z_path = "7z" # Default generico
+    default_7z_path = _default_7z_path()
 
     parser = argparse.ArgumentParser(description='Estrae ricorsivamente archivi usando 7z, sovrascrivendo il contenuto esistente.')
     parser.add_argument('work_dir', type=str, help='Directory radice contenente gli archivi da estrarre.')
@@ -190,13 +514,20 @@ if __name__ == "__main__":
                         help='Numero massimo di iterazioni per gestire archivi annidati. Default: 5')
     parser.add_argument('--log_file', type=str, default='extraction.log',
                         help='Nome del file di log. Default: extraction.log')
+    parser.add_argument('--max_workers', type=int, default=None,
+                        help='Numero massimo di estrazioni (processi 7z) in parallelo. Default: numero di CPU')
+    parser.add_argument('--no_mmt', action='store_true',
+                        help='Disattiva la decompressione multithread di 7z (-mmt), es. su macchine a singolo core.')
+    parser.add_argument('--no_cache', action='store_true',
+                        help=f'Ignora la cache {CACHE_FILE_NAME} e ri-estrae anche gli archivi invariati dall\'ultima esecuzione.')
 
     args = parser.parse_args()
 
     setup_logging(args.log_file)
 
     try:
-        recursive_extract(args.work_dir, args.path_to_7z, args.max_iterations)
+        recursive_extract(args.work_dir, args.path_to_7z, args.max_iterations, use_cache=not args.no_cache,
+                          max_workers=args.max_workers, use_mmt=not args.no_mmt)
     except Exception as e:
         logging.exception("Errore critico non gestito durante l'esecuzione dello script: %s", e)
         sys.exit(1) # Esce con codice di errore